@@ -6,37 +6,149 @@ This server provides HTTP endpoints for the Flutter app to interact with the KML
 Requirements:
     pip install flask google-generativeai python-dotenv
     
+Optional:
+    pip install orjson  (faster JSON requests and responses)
+    pip install flask-compress  (Brotli/gzip compressed responses)
+    
 Usage:
-    python flask_server.py
+    python flask_server.py                  (development)
+    gunicorn -k gthread -w 4 --threads 16 --preload -b 127.0.0.1:8000 wsgi:app   (production)
     
 Then the server will be available at http://localhost:8000
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
+from werkzeug.exceptions import HTTPException
+import asyncio
+import atexit
+import concurrent.futures
+import logging
 import os
+import queue
+import re
 import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # Fall back to Flask's stdlib JSON provider
+    orjson = None
+
+try:
+    from flask_compress import Compress
+except ImportError:  # Responses are sent uncompressed
+    Compress = None
+
 # Load environment variables
 load_dotenv()
 
 # Import the KML Agent
 from kml_agent import KMLAgent
 
+# Request threads only enqueue log records; a listener thread writes them to stderr
+log = logging.getLogger(__name__)
+_log_handler = QueueHandler(queue.SimpleQueue())
+_log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+_log_listener = None
+
+
+def _start_log_listener():
+    """Start the background thread that drains queued log records to stderr."""
+    global _log_listener
+    _log_handler.queue = queue.SimpleQueue()
+    # Records arrive already formatted by the QueueHandler
+    _log_listener = QueueListener(_log_handler.queue, logging.StreamHandler(sys.stderr))
+    _log_listener.start()
+
+
+logging.basicConfig(level=logging.INFO, handlers=[_log_handler])
+_start_log_listener()
+atexit.register(lambda: _log_listener.stop())
+# Workers forked by gunicorn --preload do not inherit the listener thread (POSIX only)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_start_log_listener)
+
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider backed by orjson, which serializes straight to bytes."""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Skip the str round-trip of the default provider and hand bytes to the response
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = ORJSONProvider(app)
+
+# Bound the memory a single request body can take (e.g. a huge /validate-kml payload)
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
+# Bodies /validate-kml accepts as raw KML instead of JSON
+KML_MIMETYPES = ('application/xml', 'text/xml', 'application/vnd.google-earth.kml+xml')
+VALIDATE_CHUNK_SIZE = 64 * 1024
+
+# KML is verbose XML and compresses well; Brotli is preferred when the client accepts it
+app.config.update(
+    COMPRESS_ALGORITHM=['br', 'gzip'],
+    COMPRESS_MIMETYPES=['application/json', 'application/xml'],
+    COMPRESS_MIN_SIZE=512,
+    COMPRESS_LEVEL=4,
+    COMPRESS_BR_LEVEL=4,
+    COMPRESS_STREAMS=False,  # Keep /generate-kml-stream unbuffered
+)
+if Compress is not None:
+    Compress(app)
+
+# Event loop that runs batch Gemini calls, started lazily in each worker process
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+# Seconds a batch request waits for all of its Gemini calls before giving up
+BATCH_TIMEOUT = float(os.getenv('BATCH_TIMEOUT', '120'))
 
 # Initialize the KML Agent
 try:
     agent = KMLAgent(api_key=os.getenv('GOOGLE_API_KEY'))
-    print('✓ KML Agent initialized successfully')
+    log.info('KML Agent initialized successfully')
 except ValueError as e:
-    print(f'✗ Failed to initialize KML Agent: {e}')
-    print('Set GOOGLE_API_KEY environment variable:')
-    print('  Windows PowerShell: $env:GOOGLE_API_KEY = "your-api-key"')
-    print('  Linux/macOS: export GOOGLE_API_KEY="your-api-key"')
+    log.error('Failed to initialize KML Agent: %s', e)
+    log.error('Set GOOGLE_API_KEY environment variable:')
+    log.error('  Windows PowerShell: $env:GOOGLE_API_KEY = "your-api-key"')
+    log.error('  Linux/macOS: export GOOGLE_API_KEY="your-api-key"')
     sys.exit(1)
 
 
+def _xml_comment(text):
+    """Make text safe inside an XML comment, which may not contain -- or end with -."""
+    return re.sub(r'-{2,}', '-', text).rstrip('-')
+
+
+def _json():
+    """
+    Parse the request body as JSON, using orjson when available.
+    
+    Large batch and validation payloads skip Flask's stdlib parser and its
+    cached copy of the body. Returns None if the body is not valid JSON.
+    """
+    if orjson is None:
+        return request.get_json(silent=True)
+    try:
+        return orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return None
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint."""
@@ -78,21 +190,163 @@ def generate_kml():
         if not prompt:
             return jsonify({'error': 'Query parameter is required'}), 400
         
-        print(f'📝 Generating KML for: "{prompt}"')
+        log.info('Generating KML for: "%s"', prompt)
         
         # Generate KML
         kml = agent.generate_kml(prompt)
         
-        print(f'✓ KML generated successfully ({len(kml)} chars)')
+        log.info('KML generated successfully (%d chars)', len(kml))
         
         return jsonify({'kml': kml}), 200
         
+    except HTTPException:
+        raise  # Answered as JSON by http_error()
     except Exception as e:
         error_msg = str(e)
-        print(f'✗ Error generating KML: {error_msg}')
+        log.error('Error generating KML: %s', error_msg)
         return jsonify({'error': error_msg}), 500
 
 
+@app.route('/generate-kml-raw', methods=['POST'])
+def generate_kml_raw():
+    """
+    Generate KML and return it as a raw XML body instead of a JSON string.
+    
+    Skips JSON escaping of every <, > and " in the KML, so clients such as the
+    Flutter app save both serialization CPU and bandwidth.
+    
+    Request JSON:
+        {
+            "query": "Fly to Eiffel Tower"
+        }
+    
+    Response:
+        application/xml body containing the KML
+    
+    Error Response:
+        {
+            "error": "Error message"
+        }
+    """
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'Request body must be JSON'}), 400
+        
+        prompt = data.get('query', '').strip()
+        
+        if not prompt:
+            return jsonify({'error': 'Query parameter is required'}), 400
+        
+        log.info('Generating raw KML for: "%s"', prompt)
+        
+        kml = agent.generate_kml(prompt)
+        
+        log.info('KML generated successfully (%d chars)', len(kml))
+        
+        return Response(kml, mimetype='application/xml'), 200
+        
+    except HTTPException:
+        raise  # Answered as JSON by http_error()
+    except Exception as e:
+        error_msg = str(e)
+        log.error('Error generating KML: %s', error_msg)
+        return jsonify({'error': error_msg}), 500
+
+
+@app.route('/generate-kml-stream', methods=['POST'])
+def generate_kml_stream():
+    """
+    Stream KML for a natural language prompt while Gemini generates it.
+    
+    Request JSON:
+        {
+            "query": "Fly to Eiffel Tower"
+        }
+    
+    Response:
+        application/xml body sent in chunks as they are generated.
+        If validation fails after streaming started, the body ends with
+        an XML comment: <!-- error: Error message -->
+    
+    Error Response (before streaming starts):
+        {
+            "error": "Error message"
+        }
+    """
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'Request body must be JSON'}), 400
+        
+        prompt = data.get('query', '').strip()
+        
+        if not prompt:
+            return jsonify({'error': 'Query parameter is required'}), 400
+        
+        log.info('Streaming KML for: "%s"', prompt)
+        
+        # Pull the first chunk eagerly so API errors still produce a JSON 500
+        chunks = agent.generate_kml_stream(prompt)
+        first = next(chunks, '')
+        
+        def stream():
+            try:
+                yield first
+                yield from chunks
+                log.info('KML streamed successfully')
+            except Exception as e:
+                error_msg = str(e)
+                log.error('Error streaming KML: %s', error_msg)
+                yield f'\n<!-- error: {_xml_comment(error_msg)} -->\n'
+        
+        return Response(stream_with_context(stream()), mimetype='application/xml')
+        
+    except HTTPException:
+        raise  # Answered as JSON by http_error()
+    except Exception as e:
+        error_msg = str(e)
+        log.error('Error generating KML: %s', error_msg)
+        return jsonify({'error': error_msg}), 500
+
+
+def _run_event_loop(loop):
+    """Run the batch event loop; every batch result is validated on this thread."""
+    KMLAgent.prepare_thread()
+    loop.run_forever()
+
+
+def _get_event_loop():
+    """Return the background event loop, starting its thread on first use."""
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_run_event_loop,
+                args=(_event_loop,),
+                name='kml-batch-loop',
+                daemon=True
+            ).start()
+        return _event_loop
+
+
+async def _generate_batch_item(prompt):
+    """Generate KML for one batch prompt, returning (kml, error)."""
+    log.info('Batch: Generating KML for: "%s"', prompt)
+    try:
+        return await agent.agenerate_kml(prompt), None
+    except Exception as e:
+        return None, str(e)
+
+
+async def _generate_batch(prompts):
+    """Generate KML for all batch prompts concurrently, keeping request order."""
+    return await asyncio.gather(*(_generate_batch_item(p) for p in prompts))
+
+
 @app.route('/generate-kml-batch', methods=['POST'])
 def generate_kml_batch():
     """
@@ -115,7 +369,7 @@ def generate_kml_batch():
         }
     """
     try:
-        data = request.get_json()
+        data = _json()
         
         if not data or 'queries' not in data:
             return jsonify({'error': 'queries array is required'}), 400
@@ -125,37 +379,49 @@ def generate_kml_batch():
         if not isinstance(queries, list) or not queries:
             return jsonify({'error': 'queries must be a non-empty array'}), 400
         
+        prompts = [str(p).strip() for p in queries]
+        prompts = [p for p in prompts if p]
+        
         results = []
         failed = []
         
-        for prompt in queries:
+        if prompts:
+            # Gemini calls are IO-bound, so overlap them all on the shared event loop
+            future = asyncio.run_coroutine_threadsafe(
+                _generate_batch(prompts),
+                _get_event_loop()
+            )
             try:
-                prompt = str(prompt).strip()
-                if not prompt:
-                    continue
-                
-                print(f'📝 Batch: Generating KML for: "{prompt}"')
-                kml = agent.generate_kml(prompt)
-                results.append({
-                    'query': prompt,
-                    'kml': kml
-                })
-            except Exception as e:
-                failed.append({
-                    'query': prompt,
-                    'error': str(e)
-                })
+                outcomes = future.result(timeout=BATCH_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                future.cancel()  # Cancels the gather and every in-flight Gemini call
+                log.error('Batch timed out after %s seconds', BATCH_TIMEOUT)
+                return jsonify({'error': f'Batch timed out after {BATCH_TIMEOUT:g} seconds'}), 504
+            
+            for prompt, (kml, error) in zip(prompts, outcomes):
+                if error is None:
+                    results.append({
+                        'query': prompt,
+                        'kml': kml
+                    })
+                else:
+                    failed.append({
+                        'query': prompt,
+                        'error': error
+                    })
         
-        print(f'✓ Batch complete: {len(results)} successful, {len(failed)} failed')
+        log.info('Batch complete: %d successful, %d failed', len(results), len(failed))
         
         return jsonify({
             'results': results,
             'failed': failed
         }), 200
         
+    except HTTPException:
+        raise  # Answered as JSON by http_error()
     except Exception as e:
         error_msg = str(e)
-        print(f'✗ Batch error: {error_msg}')
+        log.error('Batch error: %s', error_msg)
         return jsonify({'error': error_msg}), 500
 
 
@@ -169,19 +435,49 @@ def validate_kml():
             "kml": "<?xml version=\"1.0\"... </kml>"
         }
     
+    Or the raw KML document as the body, with Content-Type application/xml,
+    text/xml or application/vnd.google-earth.kml+xml. The body is validated
+    chunk by chunk as it is read, so it is never held as a single string.
+    
     Response JSON:
         {
             "valid": true/false,
-            "errors": []
+            "length": 1234
         }
+    
+    length is the number of characters of a JSON kml string, or the number of
+    bytes read from a raw body (reading stops early once the KML is invalid).
     """
     try:
-        data = request.get_json()
+        if request.mimetype in KML_MIMETYPES:
+            length = 0
+            
+            def chunks():
+                # Count what is actually read: Content-Length is absent for chunked uploads
+                nonlocal length
+                for chunk in iter(lambda: request.stream.read(VALIDATE_CHUNK_SIZE), b''):
+                    length += len(chunk)
+                    yield chunk
+            
+            is_valid = KMLAgent._is_valid_kml_stream(chunks())
+            
+            return jsonify({
+                'valid': is_valid,
+                'length': length
+            }), 200
+        
+        data = _json()
         
         if not data or 'kml' not in data:
             return jsonify({'error': 'kml parameter is required'}), 400
         
-        kml = data.get('kml', '').strip()
+        # No strip(): the validator ignores surrounding whitespace, so skip the copy
+        kml = data.get('kml') or ''
+        del data  # Only the KML string is needed from here on
+        
+        if not isinstance(kml, str):
+            return jsonify({'error': 'kml must be a string'}), 400
+        
         is_valid = KMLAgent._is_valid_kml(kml)
         
         return jsonify({
@@ -189,10 +485,53 @@ def validate_kml():
             'length': len(kml)
         }), 200
         
+    except HTTPException:
+        raise  # Answered as JSON by http_error()
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """
+    Report response cache statistics.
+    
+    Caches are per process: under gunicorn with several workers this reports
+    only the worker that serves the request.
+    
+    Response JSON:
+        {
+            "size": 12,
+            "max_size": 1024,
+            "hits": 30,
+            "misses": 12,
+            "semantic_enabled": true,
+            "semantic_size": 12,
+            "semantic_hits": 4,
+            "template_hits": 7
+        }
+    """
+    return jsonify(agent.cache_stats()), 200
+
+
+@app.route('/cache/clear', methods=['POST'])
+def cache_clear():
+    """
+    Clear the response cache.
+    
+    Caches are per process: under gunicorn with several workers this clears
+    only the worker that serves the request.
+    """
+    agent.clear_cache()
+    return jsonify({'cleared': True}), 200
+
+
+@app.errorhandler(HTTPException)
+def http_error(error):
+    """Return HTTP errors as JSON, e.g. 413 for bodies over MAX_CONTENT_LENGTH."""
+    return jsonify({'error': error.description}), error.code
+
+
 @app.errorhandler(404)
 def not_found(error):
     """Handle 404 errors."""
@@ -201,8 +540,12 @@ def not_found(error):
         'available_endpoints': [
             'GET /health',
             'POST /generate-kml',
+            'POST /generate-kml-raw',
+            'POST /generate-kml-stream',
             'POST /generate-kml-batch',
-            'POST /validate-kml'
+            'POST /validate-kml',
+            'GET /cache/stats',
+            'POST /cache/clear'
         ]
     }), 404
 
@@ -220,16 +563,22 @@ if __name__ == '__main__':
     print('\nEndpoints:')
     print('  GET  http://localhost:8000/health')
     print('  POST http://localhost:8000/generate-kml')
+    print('  POST http://localhost:8000/generate-kml-raw')
+    print('  POST http://localhost:8000/generate-kml-stream')
     print('  POST http://localhost:8000/generate-kml-batch')
     print('  POST http://localhost:8000/validate-kml')
+    print('  GET  http://localhost:8000/cache/stats')
+    print('  POST http://localhost:8000/cache/clear')
     print('\nServer starting on http://localhost:8000')
     print('Press Ctrl+C to stop')
     print('='*60 + '\n')
     
-    # Run the Flask app
+    # Run the Flask development server (use wsgi.py with gunicorn in production)
+    debug = os.getenv('FLASK_DEBUG', 'False').lower() in ('1', 'true', 'yes')
     app.run(
         host='127.0.0.1',
         port=8000,
-        debug=True,
-        use_reloader=True
+        debug=debug,
+        use_reloader=False,  # The reloader would import and configure everything twice
+        threaded=True
     )
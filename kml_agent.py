@@ -7,46 +7,58 @@ into valid KML (Keyhole Markup Language) for Liquid Galaxy visualization.
 Requirements:
     pip install google-generativeai
     
+Optional:
+    pip install sentence-transformers  (semantic cache for near-duplicate prompts)
+    pip install lxml  (well-formedness checking in KML validation)
+    
 Environment:
     Set GOOGLE_API_KEY environment variable with your Gemini API key
     Or pass api_key parameter to KMLAgent class
 """
 
+import asyncio
 import os
 import json
+import logging
 import re
-from typing import Optional
+import threading
+from collections import OrderedDict
+from typing import Iterable, Iterator, Optional
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # Semantic cache is optional
+    np = None
+    SentenceTransformer = None
+
+try:
+    from lxml import etree
+except ImportError:  # Validation falls back to tag scanning
+    etree = None
+
 load_dotenv()
 
-class KMLAgent:
-    """Generate KML from natural language using Gemini API."""
-    
-    def __init__(self, api_key: Optional[str] = None):
-        """
-        Initialize the KML Agent.
-        
-        Args:
-            api_key: Google Gemini API key. If not provided, uses GOOGLE_API_KEY env var.
-        
-        Raises:
-            ValueError: If no API key is provided or found in environment.
-        """
-        key = api_key or os.getenv('GOOGLE_API_KEY')
-        if not key:
-            raise ValueError(
-                'Google API key required. Pass api_key parameter or set GOOGLE_API_KEY env var.'
-            )
-        
-        genai.configure(api_key=key)
-        self.model = genai.GenerativeModel('gemini-3-flash-preview')
-        
-    @staticmethod
-    def _build_system_prompt() -> str:
-        """Build the system prompt for KML generation."""
-        return """You are a KML (Keyhole Markup Language) generation expert for Google Earth and Liquid Galaxy.
+log = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+
+# Full model for tours and multi-stop prompts; lighter model for single fly-to prompts
+MODEL_NAME = 'gemini-3-flash-preview'
+FAST_MODEL_NAME = 'gemini-flash-lite-latest'
+FAST_PROMPT_MAX_CHARS = 200
+
+# Upper bound on concurrent in-flight Gemini calls made through agenerate_kml
+ASYNC_MAX_CONCURRENCY = 32
+
+# GEMINI_TRANSPORT=rest switches the SDK to its REST transport. Anything else leaves
+# the choice to the SDK, which uses grpc for sync and grpc_asyncio for async calls
+USE_REST_TRANSPORT = os.getenv('GEMINI_TRANSPORT', '').lower() == 'rest'
+
+# System prompt for KML generation (static, so it is built once at import)
+_SYSTEM_PROMPT = """You are a KML (Keyhole Markup Language) generation expert for Google Earth and Liquid Galaxy.
 
 CRITICAL: Output ONLY the KML XML code. No explanations, no markdown, no code blocks, no additional text whatsoever.
 
@@ -70,6 +82,381 @@ COORDINATES:
 
 Generate ONLY KML. No extra text."""
 
+
+# Gemini models shared by every KMLAgent in the process, keyed by model name
+_models: dict = {}
+_models_lock = threading.Lock()
+_configured_key: Optional[str] = None
+
+
+def _get_model(name: str, api_key: str):
+    """Return the process-wide model for name, configuring the client only once per key."""
+    global _configured_key
+    with _models_lock:
+        if _configured_key != api_key:
+            genai.configure(
+                api_key=api_key,
+                transport='rest' if USE_REST_TRANSPORT else None,
+            )
+            _configured_key = api_key
+            _models.clear()
+        
+        model = _models.get(name)
+        if model is None:
+            # The static system prompt goes in system_instruction: it is kept apart from
+            # the user turn, and generate_content only has to be given the user text
+            model = genai.GenerativeModel(name, system_instruction=_SYSTEM_PROMPT)
+            _models[name] = model
+        return model
+
+
+# Tags every KML must contain, and tags of which at least one must be present
+_REQUIRED_ELEMENTS = ('<?xml', '<kml', '<Document>', '</Document>', '</kml>')
+_CONTENT_ELEMENTS = ('<Camera>', '<LookAt>', '<gx:FlyTo>', '<Placemark>', '<LineString>', '<Polygon>')
+
+# Alternations let the C regex engine find all tags of a group in a single pass
+_REQUIRED_RE = re.compile('|'.join(re.escape(e) for e in _REQUIRED_ELEMENTS))
+_CONTENT_RE = re.compile('|'.join(re.escape(e) for e in _CONTENT_ELEMENTS))
+
+# Phrases that mark a prompt as a single fly-to vs. a multi-stop tour
+_FLY_TO_RE = re.compile(r'\bfly to\b', re.IGNORECASE)
+_MULTI_STOP_RE = re.compile(r'\b(?:and|then|tour)\b', re.IGNORECASE)
+
+# Content elements looked up by local name (any namespace) in a parsed KML tree
+_CONTENT_TAGS = tuple(
+    '{*}' + tag for tag in ('Camera', 'LookAt', 'FlyTo', 'Placemark', 'LineString', 'Polygon')
+)
+_XML_DECL_RE = re.compile(r'\s*(?=<\?xml)')
+
+# lxml parsers must not be used by several threads at once, so keep one per thread
+_parser_local = threading.local()
+
+# Well-known locations from the system prompt, answered locally without calling Gemini
+# (name, lat, lon, qualifiers allowed after "in", e.g. "fly to tokyo in japan")
+_NEW_YORK = (
+    'New York', 40.7128, -74.0060,
+    frozenset(('usa', 'the usa', 'us', 'the us', 'united states', 'the united states', 'ny', 'new york')),
+)
+_KNOWN_LOCATIONS = {
+    'new york': _NEW_YORK,
+    'new york city': _NEW_YORK,
+    'eiffel tower': ('Eiffel Tower', 48.8584, 2.2945, frozenset(('paris', 'france', 'paris france'))),
+    'tokyo': ('Tokyo', 35.6762, 139.6503, frozenset(('japan',))),
+    'sydney': ('Sydney', -33.8568, 151.2153, frozenset(('australia', 'nsw', 'nsw australia'))),
+}
+
+# "Fly to [the] <place> [in <qualifier>]" with nothing else in the prompt
+_KNOWN_FLY_TO_RE = re.compile(
+    r'\A\s*fly to (?:the )?([a-z ]+?)(?:\s+in\s+([a-z ,]+?))?\s*[.!]?\s*\Z',
+    re.IGNORECASE,
+)
+
+_FLY_TO_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">
+  <Document>
+    <name>Fly to {name}</name>
+    <gx:Tour>
+      <name>Fly to {name}</name>
+      <gx:Playlist>
+        <gx:FlyTo>
+          <gx:duration>5</gx:duration>
+          <gx:flyToMode>smooth</gx:flyToMode>
+          <Camera>
+            <longitude>{lon}</longitude>
+            <latitude>{lat}</latitude>
+            <altitude>1000</altitude>
+            <heading>0</heading>
+            <tilt>45</tilt>
+            <roll>0</roll>
+            <altitudeMode>relativeToGround</altitudeMode>
+          </Camera>
+        </gx:FlyTo>
+      </gx:Playlist>
+    </gx:Tour>
+  </Document>
+</kml>"""
+
+# Markdown code fences Gemini sometimes wraps around the KML
+_FENCE_RE = re.compile(r'\A\s*```(?:xml)?|```\s*\Z')
+_OPENING_FENCE_RE = re.compile(r'\A\s*(?:```(?:xml)?\s*)?')
+
+
+def _strip_opening_fence(text: str) -> str:
+    """Remove a leading markdown code fence (```xml or ```) and surrounding whitespace."""
+    return _OPENING_FENCE_RE.sub('', text, count=1)
+
+
+def _kml_parser():
+    """Return this thread's hardened lxml parser (no entities, no network)."""
+    parser = getattr(_parser_local, 'parser', None)
+    if parser is None:
+        parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=False)
+        _parser_local.parser = parser
+    return parser
+
+
+def _scan_kml_tags(kml: str) -> bool:
+    """Check for the required KML tags by substring scan (used when lxml is missing)."""
+    found = set(_REQUIRED_RE.findall(kml))
+    
+    if len(found) < len(_REQUIRED_ELEMENTS):
+        for element in _REQUIRED_ELEMENTS:
+            if element not in found:
+                log.warning('Missing required KML element: %s', element)
+                return False
+    
+    # Check for at least one of: LookAt, Camera, FlyTo, Placemark
+    if not _CONTENT_RE.search(kml):
+        log.warning('KML missing geographic content')
+        return False
+    
+    return True
+
+
+def _check_kml_tree(root) -> bool:
+    """Check a parsed KML tree for a <kml> root, a Document and geographic content."""
+    if etree.QName(root).localname != 'kml':
+        log.warning('Missing required KML element: <kml')
+        return False
+    
+    if next(root.iter('{*}Document'), None) is None:
+        log.warning('Missing required KML element: <Document>')
+        return False
+    
+    # Check for at least one of: LookAt, Camera, FlyTo, Placemark
+    if next(root.iter(*_CONTENT_TAGS), None) is None:
+        log.warning('KML missing geographic content')
+        return False
+    
+    return True
+
+
+class KMLAgent:
+    """Generate KML from natural language using Gemini API."""
+    
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        cache_size: int = 1024,
+        semantic_threshold: Optional[float] = 0.92,
+        max_concurrency: int = ASYNC_MAX_CONCURRENCY,
+    ):
+        """
+        Initialize the KML Agent.
+        
+        Args:
+            api_key: Google Gemini API key. If not provided, uses GOOGLE_API_KEY env var.
+            cache_size: Maximum number of generated KMLs kept in the response cache.
+                        Use 0 to disable caching.
+            semantic_threshold: Cosine similarity above which a previous prompt's KML
+                                is reused for a new prompt. Requires sentence-transformers;
+                                use None to disable the semantic cache.
+            max_concurrency: Maximum number of agenerate_kml calls waiting on Gemini at once.
+        
+        Raises:
+            ValueError: If no API key is provided or found in environment.
+        """
+        key = api_key or os.getenv('GOOGLE_API_KEY')
+        if not key:
+            raise ValueError(
+                'Google API key required. Pass api_key parameter or set GOOGLE_API_KEY env var.'
+            )
+        
+        self.model = _get_model(MODEL_NAME, key)
+        self._generation_config = genai.types.GenerationConfig(
+            temperature=0.3,  # Lower temperature for consistency
+            max_output_tokens=4096,
+        )
+        
+        # Single fly-to KML fits in well under 1024 tokens
+        self._fast_model = _get_model(FAST_MODEL_NAME, key)
+        self._fast_generation_config = genai.types.GenerationConfig(
+            temperature=0.3,
+            max_output_tokens=1024,
+        )
+        
+        # Exact-match response cache: normalized prompt -> validated KML (LRU)
+        self._cache: 'OrderedDict[str, str]' = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        self._cache_hits = 0
+        self._cache_misses = 0
+        
+        # Semantic cache: normalized prompt embeddings -> validated KML
+        self._semantic_threshold = semantic_threshold
+        self._embedder = None
+        self._vec_matrix = None
+        if semantic_threshold is not None and SentenceTransformer is not None and cache_size > 0:
+            self._embedder = SentenceTransformer(EMBEDDING_MODEL)
+            # Ring buffer of cache_size rows: inserts overwrite the oldest row in place
+            self._vec_matrix = np.zeros(
+                (cache_size, self._embedder.get_sentence_embedding_dimension()),
+                dtype=np.float32,
+            )
+        self._vec_prompts: list = [None] * cache_size
+        self._vec_kmls: list = [None] * cache_size
+        self._vec_count = 0  # Filled rows
+        self._vec_next = 0  # Row the next insert writes to
+        self._semantic_hits = 0
+        self._template_hits = 0
+        
+        # Created on first use, inside the event loop that drives agenerate_kml
+        self._max_concurrency = max_concurrency
+        self._async_slots: Optional[asyncio.Semaphore] = None
+        
+    @staticmethod
+    def _cache_key(prompt: str) -> str:
+        """Normalize a prompt so trivially different spellings share a cache entry."""
+        return ' '.join(prompt.lower().split())
+    
+    def _cache_get(self, key: str) -> Optional[str]:
+        """Return the cached KML for key, or None if it is not cached."""
+        with self._cache_lock:
+            kml = self._cache.get(key)
+            if kml is None:
+                return None
+            self._cache.move_to_end(key)
+            self._cache_hits += 1
+            return kml
+    
+    def _cache_put(self, key: str, kml: str) -> None:
+        """Store a validated KML, evicting the least recently used entry if full."""
+        if self._cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = kml
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+    
+    def _embed(self, prompt: str):
+        """Return the normalized embedding for prompt, or None if the semantic cache is off."""
+        if self._embedder is None:
+            return None
+        return self._embedder.encode([prompt], normalize_embeddings=True)[0]
+    
+    def _semantic_get(self, embedding) -> Optional[str]:
+        """Return the KML of the most similar cached prompt above the threshold, if any."""
+        if embedding is None:
+            return None
+        with self._cache_lock:
+            if self._vec_count == 0:
+                return None
+            # Embeddings are normalized, so the dot product is the cosine similarity
+            scores = self._vec_matrix[:self._vec_count] @ embedding
+            best = int(scores.argmax())
+            if scores[best] < self._semantic_threshold:
+                return None
+            self._semantic_hits += 1
+            return self._vec_kmls[best]
+    
+    def _semantic_put(self, embedding, prompt: str, kml: str) -> None:
+        """Index a validated KML under its prompt embedding, dropping the oldest if full."""
+        if embedding is None:
+            return
+        with self._cache_lock:
+            slot = self._vec_next
+            self._vec_matrix[slot] = embedding
+            self._vec_prompts[slot] = prompt
+            self._vec_kmls[slot] = kml
+            self._vec_next = (slot + 1) % self._cache_size
+            self._vec_count = min(self._vec_count + 1, self._cache_size)
+    
+    def cache_stats(self) -> dict:
+        """Return response cache statistics."""
+        with self._cache_lock:
+            return {
+                'size': len(self._cache),
+                'max_size': self._cache_size,
+                'hits': self._cache_hits,
+                'misses': self._cache_misses,
+                'semantic_enabled': self._embedder is not None,
+                'semantic_size': self._vec_count,
+                'semantic_hits': self._semantic_hits,
+                'template_hits': self._template_hits,
+            }
+    
+    def clear_cache(self) -> None:
+        """Drop all cached responses and reset the hit/miss counters."""
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_hits = 0
+            self._cache_misses = 0
+            self._vec_prompts = [None] * self._cache_size
+            self._vec_kmls = [None] * self._cache_size
+            self._vec_count = 0
+            self._vec_next = 0
+            self._semantic_hits = 0
+            self._template_hits = 0
+    
+    @staticmethod
+    def _is_simple_prompt(prompt: str) -> bool:
+        """Return True for short prompts that fly to a single location."""
+        return (
+            len(prompt) < FAST_PROMPT_MAX_CHARS
+            and len(_FLY_TO_RE.findall(prompt)) == 1
+            and prompt.count(',') <= 1
+            and not _MULTI_STOP_RE.search(prompt)
+        )
+    
+    def _select_model(self, prompt: str):
+        """Pick the (model, generation_config) pair to use for prompt."""
+        if self._is_simple_prompt(prompt):
+            log.info('Model: %s (single fly-to prompt)', FAST_MODEL_NAME)
+            return self._fast_model, self._fast_generation_config
+        log.info('Model: %s', MODEL_NAME)
+        return self.model, self._generation_config
+    
+    def _template_kml(self, prompt: str) -> Optional[str]:
+        """Build KML locally for a plain fly-to to a well-known location, if prompt is one."""
+        match = _KNOWN_FLY_TO_RE.match(prompt)
+        if match is None:
+            return None
+        location = _KNOWN_LOCATIONS.get(' '.join(match.group(1).lower().split()))
+        if location is None:
+            return None
+        
+        name, lat, lon, qualifiers = location
+        # Any other qualifier ("sydney in nova scotia", "new york in winter") goes to Gemini
+        if match.group(2) is not None:
+            qualifier = ' '.join(match.group(2).lower().replace(',', ' ').split())
+            if qualifier not in qualifiers:
+                return None
+        
+        with self._cache_lock:
+            self._template_hits += 1
+        return _FLY_TO_TEMPLATE.format(name=name, lat=lat, lon=lon)
+    
+    def _lookup(self, prompt: str):
+        """
+        Find a KML without calling Gemini, returning (cache_key, embedding, kml or None).
+        
+        Checks the exact cache, then well-known fly-to locations, then the semantic cache.
+        """
+        cache_key = self._cache_key(prompt)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cache_key, None, cached
+        
+        templated = self._template_kml(prompt)
+        if templated is not None:
+            return cache_key, None, templated
+        
+        embedding = self._embed(cache_key)
+        cached = self._semantic_get(embedding)
+        if cached is not None:
+            self._cache_put(cache_key, cached)
+        else:
+            # Only lookups that fall through to Gemini count as misses
+            with self._cache_lock:
+                self._cache_misses += 1
+        return cache_key, embedding, cached
+    
+    def _remember(self, cache_key: str, embedding, kml: str) -> None:
+        """Store a validated KML in the exact and semantic caches."""
+        self._cache_put(cache_key, kml)
+        self._semantic_put(embedding, cache_key, kml)
+    
     def generate_kml(self, prompt: str) -> str:
         """
         Generate KML from a natural language prompt using Gemini.
@@ -88,46 +475,180 @@ Generate ONLY KML. No extra text."""
         if not prompt or not prompt.strip():
             raise ValueError('Prompt cannot be empty')
         
+        cache_key, embedding, cached = self._lookup(prompt)
+        if cached is not None:
+            return cached
+        
         try:
-            system_prompt = self._build_system_prompt()
-            
             # Call Gemini API
-            response = self.model.generate_content(
-                f"{system_prompt}\n\nUser request: {prompt}",
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.3,  # Lower temperature for consistency
-                    max_output_tokens=4096,
-                )
+            model, generation_config = self._select_model(prompt)
+            response = model.generate_content(
+                prompt,
+                generation_config=generation_config,
             )
             
-            if not response.text:
-                raise Exception('No response from Gemini API')
+            return self._finish(response, cache_key, embedding)
             
-            kml = response.text.strip()
+        except Exception as e:
+            raise Exception(f'KML generation failed: {str(e)}')
+    
+    async def agenerate_kml(self, prompt: str) -> str:
+        """
+        Async variant of generate_kml for running many prompts on one event loop.
+        
+        At most max_concurrency calls wait on Gemini at the same time.
+        
+        Args:
+            prompt: Natural language description of the KML to generate
+        
+        Returns:
+            Valid KML string
+        
+        Raises:
+            ValueError: If prompt is empty
+            Exception: If API call fails or invalid KML is generated
+        """
+        if not prompt or not prompt.strip():
+            raise ValueError('Prompt cannot be empty')
+        
+        # Embedding is CPU-bound; keep it off the event loop shared by all batch requests
+        cache_key, embedding, cached = await asyncio.to_thread(self._lookup, prompt)
+        if cached is not None:
+            return cached
+        
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self._max_concurrency)
+        
+        try:
+            model, generation_config = self._select_model(prompt)
+            async with self._async_slots:
+                if USE_REST_TRANSPORT:
+                    # The REST transport has no async client; keep the loop free with a thread
+                    response = await asyncio.to_thread(
+                        model.generate_content,
+                        prompt,
+                        generation_config=generation_config,
+                    )
+                else:
+                    response = await model.generate_content_async(
+                        prompt,
+                        generation_config=generation_config,
+                    )
             
-            # Remove markdown code blocks if present
-            if kml.startswith('```xml'):
-                kml = kml[6:]
-            if kml.startswith('```'):
-                kml = kml[3:]
-            if kml.endswith('```'):
-                kml = kml[:-3]
+            return self._finish(response, cache_key, embedding)
             
-            kml = kml.strip()
+        except Exception as e:
+            raise Exception(f'KML generation failed: {str(e)}')
+    
+    def _finish(self, response, cache_key: str, embedding) -> str:
+        """Turn a Gemini response into validated KML and cache it."""
+        if not response.text:
+            raise Exception('No response from Gemini API')
+        
+        # Remove markdown code blocks if present
+        kml = _FENCE_RE.sub('', response.text).strip()
+        
+        # Validate KML
+        if not self._is_valid_kml(kml):
+            raise Exception('Generated KML failed validation')
+        
+        self._remember(cache_key, embedding, kml)
+        return kml
+    
+    def generate_kml_stream(self, prompt: str) -> Iterator[str]:
+        """
+        Generate KML like generate_kml, yielding text chunks as Gemini produces them.
+        
+        Markdown code fences are stripped on the fly. The complete KML is validated
+        when the stream ends, so a failure is raised after all chunks were yielded.
+        
+        Args:
+            prompt: Natural language description of the KML to generate
+        
+        Yields:
+            Consecutive pieces of the KML string
+        
+        Raises:
+            ValueError: If prompt is empty
+            Exception: If API call fails or invalid KML is generated
+        """
+        if not prompt or not prompt.strip():
+            raise ValueError('Prompt cannot be empty')
+        
+        cache_key, embedding, cached = self._lookup(prompt)
+        if cached is not None:
+            yield cached
+            return
+        
+        parts = []
+        head = ''  # Start of the stream, buffered until the opening fence is resolved
+        tail = ''  # End of the stream, held back in case it is the closing fence
+        started = False
+        
+        try:
+            model, generation_config = self._select_model(prompt)
+            response = model.generate_content(
+                prompt,
+                generation_config=generation_config,
+                stream=True,
+            )
+            
+            for chunk in response:
+                if not chunk.parts:
+                    continue
+                text = chunk.text
+                
+                if not started:
+                    head += text
+                    if len(head.lstrip()) < len('```xml'):
+                        continue
+                    text = _strip_opening_fence(head)
+                    if not text:
+                        continue
+                    started = True
+                
+                pending = tail + text
+                safe = len(pending.rstrip().rstrip('`').rstrip())
+                tail = pending[safe:]
+                if safe:
+                    parts.append(pending[:safe])
+                    yield pending[:safe]
+            
+            if not started:
+                tail = _strip_opening_fence(head)
+            
+            tail = tail.rstrip()
+            if tail.endswith('```'):
+                tail = tail[:-3].rstrip()
+            if tail:
+                parts.append(tail)
+                yield tail
+            
+            kml = ''.join(parts)
+            if not kml:
+                raise Exception('No response from Gemini API')
             
             # Validate KML
             if not self._is_valid_kml(kml):
                 raise Exception('Generated KML failed validation')
             
-            return kml
+            self._remember(cache_key, embedding, kml)
             
         except Exception as e:
             raise Exception(f'KML generation failed: {str(e)}')
     
+    @staticmethod
+    def prepare_thread() -> None:
+        """Create the calling thread's KML parser now instead of on its first validation."""
+        if etree is not None:
+            _kml_parser()
+    
     @staticmethod
     def _is_valid_kml(kml: str) -> bool:
         """
-        Validate that the KML has required elements.
+        Validate that the KML is well-formed and has required elements.
+        
+        Parses with lxml when installed, otherwise falls back to scanning for tags.
         
         Args:
             kml: KML string to validate
@@ -135,34 +656,71 @@ Generate ONLY KML. No extra text."""
         Returns:
             True if KML has required structure, False otherwise
         """
-        required_elements = [
-            '<?xml',
-            '<kml',
-            '<Document>',
-            '</Document>',
-            '</kml>',
-        ]
-        
-        for element in required_elements:
-            if element not in kml:
-                print(f'Warning: Missing required KML element: {element}')
-                return False
+        if etree is None:
+            return _scan_kml_tags(kml)
+        
+        declaration = _XML_DECL_RE.match(kml)
+        if declaration is None:
+            log.warning('Missing required KML element: <?xml')
+            return False
+        
+        # lxml rejects anything before the XML declaration, so skip leading whitespace
+        if declaration.end():
+            kml = kml[declaration.end():]
+        
+        try:
+            root = etree.fromstring(kml.encode('utf-8'), _kml_parser())
+        except etree.XMLSyntaxError as e:
+            log.warning('KML is not well-formed XML: %s', e)
+            return False
+        
+        return _check_kml_tree(root)
+    
+    @staticmethod
+    def _is_valid_kml_stream(chunks: Iterable[bytes]) -> bool:
+        """
+        Validate KML read as byte chunks, without building the document as a string.
+        
+        With lxml the chunks are fed straight into the parser and reading stops at
+        the first syntax error. Without lxml the chunks are joined and scanned.
         
-        # Check for at least one of: LookAt, Camera, FlyTo, Placemark
-        has_content = any(elem in kml for elem in [
-            '<Camera>',
-            '<LookAt>',
-            '<gx:FlyTo>',
-            '<Placemark>',
-            '<LineString>',
-            '<Polygon>',
-        ])
-        
-        if not has_content:
-            print('Warning: KML missing geographic content')
+        Args:
+            chunks: UTF-8 encoded KML, in pieces (e.g. read from a request stream)
+        
+        Returns:
+            True if KML has required structure, False otherwise
+        """
+        if etree is None:
+            return _scan_kml_tags(b''.join(chunks).decode('utf-8', errors='replace'))
+        
+        # A fresh parser per document: a feed parser keeps state between chunks
+        parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=False)
+        head = b''
+        started = False
+        
+        try:
+            for chunk in chunks:
+                if not started:
+                    # lxml rejects anything before the XML declaration, so skip leading whitespace
+                    head = (head + chunk).lstrip()
+                    if len(head) < len(b'<?xml'):
+                        continue
+                    if not head.startswith(b'<?xml'):
+                        break
+                    chunk = head
+                    started = True
+                parser.feed(chunk)
+            
+            if not started:
+                log.warning('Missing required KML element: <?xml')
+                return False
+            
+            root = parser.close()
+        except etree.XMLSyntaxError as e:
+            log.warning('KML is not well-formed XML: %s', e)
             return False
         
-        return True
+        return _check_kml_tree(root)
 
 
 def main():
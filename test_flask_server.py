@@ -0,0 +1,148 @@
+"""
+Tests for the Flask server endpoints.
+
+Gemini is never called: endpoints that generate KML have the agent's
+generator replaced.
+
+Usage:
+    python -m pytest test_flask_server.py
+"""
+
+import asyncio
+import io
+import os
+
+import pytest
+
+os.environ.setdefault('GOOGLE_API_KEY', 'test-key')
+flask_server = pytest.importorskip('flask_server')
+etree = pytest.importorskip('lxml.etree')
+
+import kml_agent
+
+KML = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<kml xmlns="http://www.opengis.net/kml/2.2">'
+    '<Document><Placemark><name>Berlin</name></Placemark></Document></kml>'
+)
+
+
+@pytest.fixture
+def client():
+    return flask_server.app.test_client()
+
+
+@pytest.mark.parametrize('message', [
+    'plain message',
+    'a -- b',
+    'a --- b',
+    'ends with -',
+    'ends with --',
+    '---',
+])
+def test_stream_error_comment_is_well_formed(client, monkeypatch, message):
+    def failing_stream(prompt):
+        yield KML
+        raise Exception(message)
+
+    monkeypatch.setattr(flask_server.agent, 'generate_kml_stream', failing_stream)
+
+    body = client.post('/generate-kml-stream', json={'query': 'Show Berlin'}).get_data(as_text=True)
+
+    head, comment = body.rsplit('\n<!-- error:', 1)
+    assert head == KML
+    node = etree.fromstring(f'<r><!-- error:{comment}</r>')[0]
+    assert isinstance(node, etree._Comment)
+
+
+def test_validate_raw_body_reports_bytes(client):
+    document = KML.replace('Berlin', 'Zürich')
+
+    response = client.post('/validate-kml', data=document.encode('utf-8'), content_type='application/xml')
+
+    assert response.status_code == 200
+    assert response.get_json() == {'valid': True, 'length': len(document.encode('utf-8'))}
+
+
+def test_validate_raw_chunked_body(client):
+    data = KML.encode('utf-8')
+
+    response = client.post(
+        '/validate-kml',
+        input_stream=io.BytesIO(data),
+        content_type='application/vnd.google-earth.kml+xml',
+        headers={'Transfer-Encoding': 'chunked'},
+        environ_overrides={'wsgi.input_terminated': True},
+    )
+
+    assert response.get_json() == {'valid': True, 'length': len(data)}
+
+
+def test_validate_raw_invalid_body(client):
+    response = client.post('/validate-kml', data=b'<kml></kml>', content_type='text/xml')
+
+    assert response.get_json()['valid'] is False
+
+
+def test_validate_json_body_reports_characters(client):
+    document = KML.replace('Berlin', 'Zürich')
+
+    response = client.post('/validate-kml', json={'kml': document})
+
+    assert response.get_json() == {'valid': True, 'length': len(document)}
+
+
+@pytest.mark.parametrize('body', [
+    {'json': {}},
+    {'json': {'kml': 42}},
+    {'data': b'{not json', 'content_type': 'application/json'},
+])
+def test_validate_json_body_errors(client, body):
+    response = client.post('/validate-kml', **body)
+
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+@pytest.mark.parametrize('endpoint, content_type', [
+    ('/validate-kml', 'application/xml'),
+    ('/validate-kml', 'application/json'),
+    ('/generate-kml', 'application/json'),
+    ('/generate-kml-stream', 'application/json'),
+    ('/generate-kml-batch', 'application/json'),
+])
+def test_oversized_body_is_json_413(client, monkeypatch, endpoint, content_type):
+    monkeypatch.setitem(flask_server.app.config, 'MAX_CONTENT_LENGTH', 1024)
+
+    response = client.post(endpoint, data=b' ' * 2048, content_type=content_type)
+
+    assert response.status_code == 413
+    assert 'error' in response.get_json()
+
+
+@pytest.mark.parametrize('body, status', [
+    ({'data': 'Show Berlin', 'content_type': 'text/plain'}, 415),
+    ({'data': '{not json', 'content_type': 'application/json'}, 400),
+])
+def test_http_errors_are_json(client, body, status):
+    response = client.post('/generate-kml', **body)
+
+    assert response.status_code == status
+    assert response.is_json
+    assert response.get_json()['error']
+
+
+def test_unknown_endpoint_lists_endpoints(client):
+    response = client.get('/no-such-endpoint')
+
+    assert response.status_code == 404
+    assert 'POST /validate-kml' in response.get_json()['available_endpoints']
+
+
+def test_batch_loop_thread_has_a_parser():
+    async def has_parser():
+        return getattr(kml_agent._parser_local, 'parser', None) is not None
+
+    loop = flask_server._get_event_loop()
+
+    assert asyncio.run_coroutine_threadsafe(has_parser(), loop).result(timeout=5)
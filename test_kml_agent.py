@@ -0,0 +1,233 @@
+"""
+Tests for KMLAgent.
+
+agenerate_kml runs against the real google-generativeai client. Only the gRPC
+channel is replaced, so the SDK still picks and builds its own async client
+and transport; the stubbed RPC returns a canned KML response.
+
+Usage:
+    python -m pytest test_kml_agent.py
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+genai = pytest.importorskip('google.generativeai')
+from google.ai import generativelanguage as glm
+from google.ai.generativelanguage_v1beta.services.generative_service.transports import (
+    grpc as grpc_sync,
+    grpc_asyncio,
+)
+
+import kml_agent
+from kml_agent import KMLAgent
+
+KML = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<kml xmlns="http://www.opengis.net/kml/2.2">'
+    '<Document><Placemark><name>Berlin</name></Placemark></Document></kml>'
+)
+
+
+class FakeAioChannel:
+    """Stands in for grpc.aio.Channel; every unary call returns a fixed KML response."""
+
+    def __init__(self):
+        self._unary_unary_interceptors = []
+        self.calls = 0
+
+    def unary_unary(self, method, request_serializer=None, response_deserializer=None, **kwargs):
+        async def call(request, timeout=None, metadata=None, **kwargs):
+            self.calls += 1
+            await asyncio.sleep(0)
+            return glm.GenerateContentResponse(candidates=[{
+                'content': {'role': 'model', 'parts': [{'text': '```xml\n' + KML + '\n```'}]},
+                'finish_reason': 'STOP',
+            }])
+        return call
+
+    def unary_stream(self, method, **kwargs):
+        # Streaming methods are registered at transport init but never called here
+        def call(request, timeout=None, metadata=None, **kwargs):
+            raise AssertionError(f'unexpected streaming call to {method}')
+        return call
+
+
+@pytest.fixture
+def channel(monkeypatch):
+    fake = FakeAioChannel()
+    monkeypatch.setattr(
+        grpc_asyncio.GenerativeServiceGrpcAsyncIOTransport,
+        'create_channel',
+        classmethod(lambda cls, *args, **kwargs: fake),
+    )
+
+    def no_sync_channel(cls, *args, **kwargs):
+        raise AssertionError('async call went through the synchronous gRPC transport')
+
+    monkeypatch.setattr(
+        grpc_sync.GenerativeServiceGrpcTransport,
+        'create_channel',
+        classmethod(no_sync_channel),
+    )
+    # Force a fresh genai.configure() and fresh SDK clients for this test
+    monkeypatch.setattr(kml_agent, '_configured_key', None)
+    return fake
+
+
+def test_agenerate_kml_uses_async_grpc_client(channel):
+    agent = KMLAgent(api_key='test-key', semantic_threshold=None)
+
+    async def run():
+        return await asyncio.gather(
+            agent.agenerate_kml('Show Berlin'),
+            agent.agenerate_kml('Show Berlin at night'),
+        )
+
+    assert asyncio.run(run()) == [KML, KML]
+    assert channel.calls == 2
+
+    # Results are cached like generate_kml results
+    assert asyncio.run(agent.agenerate_kml('show berlin')) == KML
+    assert channel.calls == 2
+
+
+@pytest.mark.parametrize('prompt, templated', [
+    ('Fly to Eiffel Tower', True),
+    ('fly to the eiffel tower in Paris, France.', True),
+    ('Fly to Tokyo in Japan', True),
+    ('fly to sydney in australia', True),
+    ('fly to sydney in nova scotia', False),
+    ('fly to new york in winter', False),
+    ('fly to tokyo in 3 seconds', False),
+    ('Fly to Berlin', False),
+])
+def test_known_location_template(prompt, templated):
+    agent = KMLAgent(api_key='test-key', semantic_threshold=None)
+
+    kml = agent._template_kml(prompt)
+
+    assert (kml is not None) == templated
+    if templated:
+        assert KMLAgent._is_valid_kml(kml)
+
+
+def test_template_hit_is_not_a_miss(channel):
+    agent = KMLAgent(api_key='test-key', semantic_threshold=None)
+
+    for _ in range(3):
+        assert agent.generate_kml('Fly to Tokyo') is not None
+    asyncio.run(agent.agenerate_kml('Show Berlin'))
+
+    stats = agent.cache_stats()
+    assert (stats['template_hits'], stats['misses']) == (3, 1)
+    assert channel.calls == 1
+
+
+class FakeStreamModel:
+    """Returns a canned Gemini reply whole, or streamed in chunks of a fixed size."""
+
+    def __init__(self, text, size):
+        self.text = text
+        self.size = size
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        if not stream:
+            return SimpleNamespace(text=self.text)
+        return [
+            SimpleNamespace(parts=[None], text=self.text[i:i + self.size])
+            for i in range(0, len(self.text), self.size)
+        ]
+
+
+def _fake_agent(monkeypatch, model):
+    agent = KMLAgent(api_key='test-key', semantic_threshold=None)
+    monkeypatch.setattr(agent, '_select_model', lambda prompt: (model, None))
+    return agent
+
+
+@pytest.mark.parametrize('size', range(1, 12))
+@pytest.mark.parametrize('reply', [
+    KML,
+    '```xml\n' + KML + '\n```',
+    '```\n' + KML + '\n```\n',
+    '  \n```xml' + KML + '```  ',
+    '\n\n' + KML + '\n\n',
+    '```xml\n' + KML.replace('Berlin', 'a `quoted` name') + '\n```',
+])
+def test_stream_strips_fences_like_generate_kml(monkeypatch, reply, size):
+    model = FakeStreamModel(reply, size)
+
+    streamed = ''.join(_fake_agent(monkeypatch, model).generate_kml_stream('Show Berlin'))
+
+    assert streamed == _fake_agent(monkeypatch, model).generate_kml('Show Berlin')
+
+
+@pytest.mark.parametrize('size', [1, 4, 1000])
+def test_stream_raises_after_invalid_kml(monkeypatch, size):
+    reply = '```xml\n<?xml version="1.0"?><kml><Document></Document></kml>\n```'
+    agent = _fake_agent(monkeypatch, FakeStreamModel(reply, size))
+
+    chunks = []
+    with pytest.raises(Exception, match='failed validation'):
+        for chunk in agent.generate_kml_stream('Show Berlin'):
+            chunks.append(chunk)
+
+    assert ''.join(chunks) == reply[len('```xml\n'):-len('\n```')]
+    assert agent.cache_stats()['size'] == 0
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 8, 64, 100000])
+@pytest.mark.parametrize('document, valid', [
+    (KML, True),
+    ('  \n\t' + KML, True),
+    (KML.replace('Berlin', 'Zürich'), True),
+    (KML.split('\n', 1)[1], False),
+    ('junk' + KML, False),
+    ('<?xm', False),
+    ('   ', False),
+    (KML[:-3], False),
+    (KML.replace('<Placemark><name>Berlin</name></Placemark>', ''), False),
+])
+def test_is_valid_kml_stream(document, valid, size):
+    data = document.encode('utf-8')
+    chunks = (data[i:i + size] for i in range(0, len(data), size))
+
+    assert KMLAgent._is_valid_kml_stream(chunks) is valid
+    assert KMLAgent._is_valid_kml(document) is valid
+
+
+class FakeEmbedder:
+    """Embeds each distinct prompt as its own unit vector."""
+
+    def __init__(self, name):
+        self.vocab = {}
+
+    def get_sentence_embedding_dimension(self):
+        return 8
+
+    def encode(self, prompts, normalize_embeddings=False):
+        np = kml_agent.np
+        rows = np.zeros((len(prompts), 8), dtype=np.float32)
+        for i, prompt in enumerate(prompts):
+            rows[i, self.vocab.setdefault(prompt, len(self.vocab) % 8)] = 1.0
+        return rows
+
+
+def test_semantic_cache_evicts_oldest(monkeypatch):
+    monkeypatch.setattr(kml_agent, 'np', pytest.importorskip('numpy'))
+    monkeypatch.setattr(kml_agent, 'SentenceTransformer', FakeEmbedder)
+    agent = KMLAgent(api_key='test-key', cache_size=2)
+
+    for prompt in ('a', 'b', 'c'):
+        agent._semantic_put(agent._embed(prompt), prompt, f'kml {prompt}')
+
+    assert agent.cache_stats()['semantic_size'] == 2
+    assert agent._semantic_get(agent._embed('a')) is None
+    assert agent._semantic_get(agent._embed('b')) == 'kml b'
+    assert agent._semantic_get(agent._embed('c')) == 'kml c'
+
+    agent.clear_cache()
+    assert agent._semantic_get(agent._embed('c')) is None
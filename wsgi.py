@@ -0,0 +1,28 @@
+"""
+WSGI entry point for running the KML Agent server under a production server.
+
+Requirements:
+    pip install gunicorn
+
+Usage:
+    gunicorn -k gthread -w 4 --threads 16 --preload -b 127.0.0.1:8000 wsgi:app
+
+Threaded workers let slow Gemini calls overlap instead of queueing behind each
+other. gthread is used rather than gevent because the Gemini client talks gRPC,
+which does not cooperate with gevent's monkey-patching.
+
+--preload imports the app once in the master, so the agent and its models are
+set up a single time before the workers are forked. Nothing may call Gemini at
+import time: gRPC channels must be opened after the fork.
+
+Each worker process has its own response caches (exact, semantic and template
+counters). With -w 4, /cache/stats reports and /cache/clear clears only the
+worker that serves the request. For one cache shared by all requests, run a
+single worker with more threads instead:
+
+    gunicorn -k gthread -w 1 --threads 64 --preload -b 127.0.0.1:8000 wsgi:app
+"""
+
+from flask_server import app
+
+__all__ = ['app']